@@ -4,48 +4,122 @@ MCP Server for managing code graph structure.
 Provides tools to create and manage nodes and edges representing code structure.
 """
 
+import atexit
+import functools
 import json
+import mmap
 import os
 import shutil
+import sys
+import threading
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
 from pathlib import Path
 from typing import Any
 
 from fastmcp import FastMCP
 
+try:
+    import orjson
+except ImportError:  # Fall back to the stdlib encoder when orjson is unavailable
+    orjson = None
+
 # Initialize FastMCP server
 mcp = FastMCP("Code Graph Server")
 
 # Configuration
 DEFAULT_GRAPH_FILE = "code_graph.json"
 GRAPH_FILE_PATH = os.getenv("GRAPH_FILE_PATH", str(Path(__file__).parent / DEFAULT_GRAPH_FILE))
+# "sync" fsyncs every save; "batched" skips the per-save fsync and syncs once at shutdown
+FLUSH_MODE = os.getenv("FLUSH_MODE", "sync")
+# Buffer size for graph file I/O; larger than the 8 KiB default to cut syscalls on big graphs
+IO_BUFFER_SIZE = 1 << 16
+# Graph files larger than this are parsed straight from a read-only memory map
+MMAP_THRESHOLD = 4 << 20
+# "full" rewrites the graph file on every change; "log" appends changes to a sidecar
+# log (code_graph.log next to code_graph.json) until compact_graph() folds them back in.
+# The viewer only reads the JSON file, so logged changes show up there after compaction.
+WRITE_MODE = os.getenv("WRITE_MODE", "full")
+# In "log" mode, the log is compacted into the graph file once it grows past this
+# fraction of the graph file's size
+LOG_COMPACT_RATIO = 0.1
+
+# Valid node types
+NODE_TYPES = {"file", "class", "function"}
+
+# Metadata fields each node type must carry, defaulting to an empty list
+METADATA_DEFAULTS = {
+    # File metadata lists classes and functions; brief_summary is optional
+    "file": ("classes", "functions"),
+    # Class metadata lists method and attribute names; children and brief_summary are optional
+    "class": ("functions", "attributes"),
+    # Function metadata lists parameters; returns, brief_summary and full_documentation are optional
+    "function": ("parameters",),
+}
+
+# Valid source code file extensions (a tuple so str.endswith can test them all in one call)
+VALID_EXTENSIONS = ('.py', '.js', '.ts', '.java', '.cpp', '.c', '.h', '.hpp',
+                    '.cs', '.rb', '.go', '.rs', '.php', '.swift', '.kt')
+
+# Node and edge type values repeat on every item; share one interned copy of each instead
+# of keeping a fresh string per occurrence from the JSON parser
+_CANONICAL_TYPES = {t: sys.intern(t) for t in ("file", "class", "function", "inherit", "invokes", "contains")}
+
+# Valid edge types, keyed by their canonical spelling so most edges need a single lookup
+EDGE_TYPE_CANON = {t: _CANONICAL_TYPES[t] for t in ("inherit", "invokes", "contains")}
+
+
+def _dumps(obj: Any, indent: bool = False) -> bytes:
+    """Serialize an object to UTF-8 JSON bytes (compact unless indent is set)."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0)
+        except orjson.JSONEncodeError:
+            # Ints wider than 64 bits, non-str keys, lone surrogates, ...: the stdlib
+            # encoder handles these, escaping non-ASCII so the output always encodes
+            pass
+    if indent:
+        return json.dumps(obj, indent=2).encode("utf-8")
+    return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+
+def _loads(data: bytes | memoryview) -> Any:
+    """Parse JSON bytes, using orjson when available."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(bytes(data))
+
+
+def _normalize_highlight(item: dict[str, Any]) -> list[int]:
+    """Coerce an item's highlight field to a list of colors and return it.
+
+    Accepts the old single-int format; exact type() checks keep the common list case cheap.
+    """
+    highlight = item.get("highlight")
+    highlight_type = type(highlight)
+    if highlight_type is list:
+        return highlight
 
-
-def load_graph() -> dict[str, Any]:
-    """Load the graph from JSON file, create if doesn't exist."""
-    if not os.path.exists(GRAPH_FILE_PATH):
-        # Create empty graph
-        graph = {"nodes": [], "edges": [], "highlightQuestions": {}}
-        save_graph(graph)
-        return graph
-
-    with open(GRAPH_FILE_PATH, "r") as f:
-        graph = json.load(f)
-        # Ensure highlightQuestions exists
-        if "highlightQuestions" not in graph:
-            graph["highlightQuestions"] = {}
-        return graph
+    highlight = [highlight] if highlight_type is int and highlight > 0 else []
+    item["highlight"] = highlight
+    return highlight
 
 
-def save_graph(graph: dict[str, Any]) -> None:
-    """Save the graph to JSON file."""
-    with open(GRAPH_FILE_PATH, "w") as f:
-        json.dump(graph, f, indent=2)
+def _fsync_dir(path: str) -> None:
+    """Flush a directory's entries (renames, removals) to disk; a no-op where unsupported."""
+    if os.name != "posix":
+        return
+    fd = os.open(path or ".", os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
 
 
-def get_next_edge_id(graph: dict[str, Any]) -> str:
-    """Generate next edge ID."""
+def _scan_next_edge_id(graph: dict[str, Any]) -> int:
+    """Compute the next edge number by scanning existing edges (migrates legacy files)."""
     if not graph["edges"]:
-        return "edge_0"
+        return 0
 
     # Extract numeric part from existing edge IDs
     max_id = 0
@@ -57,7 +131,317 @@ def get_next_edge_id(graph: dict[str, Any]) -> str:
             except (IndexError, ValueError):
                 continue
 
-    return f"edge_{max_id + 1}"
+    return max_id + 1
+
+
+class GraphStore:
+    """Owns one graph file: its cached parse, lookup indexes, change log and deferred saves.
+
+    Every tool goes through the module-level _store. FastMCP may serve tool calls
+    concurrently, so all access to the graph happens under the store's re-entrant lock.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.lock = threading.RLock()
+
+        # Cached parse of the graph file, so tool calls don't re-read the file every time.
+        # It is only trusted while the file's (mtime_ns, size) stamp is unchanged, which
+        # keeps edits made by other writers visible.
+        self._cache: dict[str, Any] | None = None
+        self._stamp: tuple[int, int] | None = None
+
+        # Side-car indexes over the cached graph, kept in sync as tools append nodes and edges
+        self.node_index: dict[str, int] = {}
+        self.edge_sig_index: dict[tuple[str, str, str], int] = {}
+        self.edge_id_index: dict[str, int] = {}
+        # Adjacency: node id -> ids of edges leaving (out_adj) or entering (in_adj) the node
+        self.out_adj: dict[str, list[str]] = {}
+        self.in_adj: dict[str, list[str]] = {}
+
+        # Nesting depth of transaction() and the save deferred to its outermost exit.
+        # _txn_ops becomes None once any deferred save asked for a full rewrite, and
+        # _txn_failed records that some level of the transaction raised.
+        self._txn_depth = 0
+        self._txn_dirty = False
+        self._txn_failed = False
+        self._txn_graph: dict[str, Any] | None = None
+        self._txn_ops: list[dict[str, Any]] | None = []
+
+    @property
+    def log_path(self) -> str:
+        """Path of the append-only change log belonging to the graph file."""
+        return os.path.splitext(self.path)[0] + ".log"
+
+    def reset(self, path: str) -> None:
+        """Switch to another graph file, dropping everything cached for the current one."""
+        with self.lock:
+            self.path = path
+            self._set_cache(None)
+
+    def load(self) -> dict[str, Any]:
+        """Load the graph from JSON file, create if doesn't exist."""
+        with self.lock:
+            try:
+                st = os.stat(self.path)
+            except FileNotFoundError:
+                # Create empty graph (written right away, even inside a transaction)
+                graph = {"nodes": [], "edges": [], "highlightQuestions": {}, "_nextEdgeId": 0}
+                self._write(graph)
+                return graph
+
+            # Reuse the cached graph unless the file was modified externally
+            if self._cache is not None and self._stamp == _file_stamp(st):
+                return self._cache
+
+            with open(self.path, "rb", buffering=IO_BUFFER_SIZE) as f:
+                # The whole file is read front to back, so let the kernel read ahead aggressively
+                if hasattr(os, "posix_fadvise"):
+                    os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                st = os.fstat(f.fileno())
+                if st.st_size > MMAP_THRESHOLD:
+                    # Parse large files from the page cache without copying them into a bytes object
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+                        graph = _loads(view)
+                else:
+                    graph = _loads(f.read())
+            # Ensure highlightQuestions exists
+            if "highlightQuestions" not in graph:
+                graph["highlightQuestions"] = {}
+            # Files written before the edge counter was persisted get it computed once here
+            if "_nextEdgeId" not in graph:
+                graph["_nextEdgeId"] = _scan_next_edge_id(graph)
+
+            # Apply changes appended to the log since the graph file was last written
+            self.replay_ops(graph)
+
+            self._set_cache(graph, st)
+            return graph
+
+    def save(self, graph: dict[str, Any], ops: list[dict[str, Any]] | None = None) -> None:
+        """Save the graph to JSON file and keep it as the cached graph.
+
+        The graph is written to a temporary file that atomically replaces the old one,
+        so a crash mid-write never leaves a truncated graph behind. In "log" write mode,
+        passing the ops describing the change appends just those to the log instead.
+        Inside transaction() the save is deferred until the transaction ends.
+        """
+        with self.lock:
+            if self._txn_depth:
+                self._txn_dirty = True
+                self._txn_graph = graph
+                if ops is None or self._txn_ops is None:
+                    self._txn_ops = None
+                else:
+                    self._txn_ops.extend(ops)
+                return
+
+            self._write(graph, ops)
+
+    @contextmanager
+    def transaction(self) -> Iterator[None]:
+        """Coalesce every save() call made inside the block into one save at its end.
+
+        The lock is held for the whole block, so a tool's read-modify-write cycle is
+        atomic with respect to other tool calls. Transactions nest; only the outermost
+        one writes the graph. If the block or the final write raises, the cached graph
+        (which tools edit in place) is dropped, so the next call reloads it from disk.
+        """
+        with self.lock:
+            self._txn_depth += 1
+            try:
+                yield
+            except BaseException:
+                self._txn_failed = True
+                raise
+            finally:
+                self._txn_depth -= 1
+                if self._txn_depth == 0:
+                    failed, dirty = self._txn_failed, self._txn_dirty
+                    graph, ops = self._txn_graph, self._txn_ops
+                    self._txn_failed, self._txn_dirty, self._txn_graph, self._txn_ops = False, False, None, []
+                    if failed:
+                        self._set_cache(None)
+                    elif dirty:
+                        try:
+                            self._write(graph, ops)
+                        except BaseException:
+                            self._set_cache(None)
+                            raise
+
+    def compact(self) -> None:
+        """Fold the change log into the graph file, if there is one."""
+        with self.lock:
+            graph = self.load()
+            if os.path.exists(self.log_path):
+                self._write(graph)
+
+    def append_ops(self, ops: list[dict[str, Any]]) -> int:
+        """Append change records to the graph's log, one JSON object per line.
+
+        Returns:
+            int: Size of the log in bytes after appending
+        """
+        with open(self.log_path, "ab", buffering=IO_BUFFER_SIZE) as f:
+            if ops:
+                f.write(b"".join(_dumps(op) + b"\n" for op in ops))
+                if FLUSH_MODE != "batched":
+                    f.flush()
+                    os.fsync(f.fileno())
+            return f.tell()
+
+    def replay_ops(self, graph: dict[str, Any]) -> None:
+        """Apply the records in the graph's log to graph, skipping ones already applied.
+
+        Replaying is idempotent, so a crash between rewriting the graph file and removing
+        the log cannot duplicate nodes or edges.
+        """
+        if not os.path.exists(self.log_path):
+            return
+
+        nodes_by_id = {node["id"]: node for node in graph["nodes"]}
+        edges_by_id = {edge["id"]: edge for edge in graph["edges"]}
+
+        with open(self.log_path, "rb", buffering=IO_BUFFER_SIZE) as f:
+            for line in f:
+                try:
+                    op = _loads(line)
+                except ValueError:
+                    # A torn final line from an interrupted append
+                    continue
+
+                kind = op.get("op")
+                if kind == "add_node":
+                    node = op["data"]
+                    if node["id"] not in nodes_by_id:
+                        graph["nodes"].append(node)
+                        nodes_by_id[node["id"]] = node
+                elif kind == "add_edge":
+                    edge = op["data"]
+                    if edge["id"] not in edges_by_id:
+                        graph["edges"].append(edge)
+                        edges_by_id[edge["id"]] = edge
+                        graph["_nextEdgeId"] = max(graph["_nextEdgeId"], int(edge["id"].split("_")[1]) + 1)
+                elif kind in ("highlight_node", "highlight_edge"):
+                    items = nodes_by_id if kind == "highlight_node" else edges_by_id
+                    item = items.get(op["id"])
+                    if item is None:
+                        continue
+                    highlight = _normalize_highlight(item)
+                    if op["color"] not in highlight:
+                        highlight.append(op["color"])
+                elif kind == "set_question":
+                    graph["highlightQuestions"][op["color"]] = op["question"]
+
+    def sync(self) -> None:
+        """Flush the graph file and its log to disk (used at shutdown in batched mode)."""
+        with self.lock:
+            for path in (self.path, self.log_path):
+                if not os.path.exists(path):
+                    continue
+                fd = os.open(path, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+            _fsync_dir(os.path.dirname(self.path))
+
+    def index_edge(self, edge: dict[str, Any], idx: int) -> None:
+        """Record the edge stored at position idx in the edge indexes and adjacency lists."""
+        edge["type"] = _CANONICAL_TYPES.get(edge["type"], edge["type"])
+        self.edge_sig_index[(edge["source"], edge["target"], edge["type"])] = idx
+        self.edge_id_index[edge["id"]] = idx
+        self.out_adj.setdefault(edge["source"], []).append(edge["id"])
+        self.in_adj.setdefault(edge["target"], []).append(edge["id"])
+
+    def _write(self, graph: dict[str, Any], ops: list[dict[str, Any]] | None = None) -> None:
+        """Persist graph immediately; see save()."""
+        if ops is not None and WRITE_MODE == "log":
+            log_size = self.append_ops(ops)
+            # Keep appending while the log is small next to the graph file; past that,
+            # replaying it costs more than rewriting, so fall through and compact
+            if self._stamp is not None and log_size <= LOG_COMPACT_RATIO * self._stamp[1]:
+                self._set_cache(graph)
+                return
+
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, "wb", buffering=IO_BUFFER_SIZE) as f:
+                f.write(_dumps(graph))
+                f.flush()
+                if FLUSH_MODE != "batched":
+                    os.fsync(f.fileno())
+                # Stamp the cache from the file we wrote, not whatever is at the path afterwards
+                st = os.fstat(f.fileno())
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            # Don't leave a partial temp file behind (e.g. when the disk is full)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        # The graph file now holds everything the log did
+        if os.path.exists(self.log_path):
+            os.remove(self.log_path)
+
+        # Make the rename itself durable, not just the file contents
+        if FLUSH_MODE != "batched":
+            _fsync_dir(os.path.dirname(self.path))
+
+        self._set_cache(graph, st)
+
+    def _set_cache(self, graph: dict[str, Any] | None, st: os.stat_result | None = None) -> None:
+        """Remember graph as the cached state of the graph file (None clears the cache).
+
+        st is the stat of the file contents graph corresponds to; it is taken fresh if omitted.
+        """
+        # Tools update the indexes incrementally, so only a different graph needs a rebuild
+        if graph is None or graph is not self._cache:
+            self._build_indexes(graph)
+
+        self._cache = graph
+        if graph is None:
+            self._stamp = None
+        else:
+            self._stamp = _file_stamp(st or os.stat(self.path))
+
+    def _build_indexes(self, graph: dict[str, Any] | None) -> None:
+        """Rebuild the node/edge lookup indexes for graph in a single pass over each list."""
+        self.node_index = {}
+        self.edge_sig_index = {}
+        self.edge_id_index = {}
+        self.out_adj = {}
+        self.in_adj = {}
+        if graph is None:
+            return
+
+        for i, node in enumerate(graph["nodes"]):
+            if "type" in node:
+                node["type"] = _CANONICAL_TYPES.get(node["type"], node["type"])
+            self.node_index[node["id"]] = i
+        for i, edge in enumerate(graph["edges"]):
+            self.index_edge(edge, i)
+
+
+def _file_stamp(st: os.stat_result) -> tuple[int, int]:
+    """Return the (mtime_ns, size) pair used to detect changes to the graph file."""
+    return st.st_mtime_ns, st.st_size
+
+
+def transactional(func: Callable[..., Any]) -> Callable[..., Any]:
+    """Run func inside a store transaction, so all of its saves become a single write."""
+    @functools.wraps(func)
+    def wrapper(*args: Any, **kwargs: Any) -> Any:
+        with _store.transaction():
+            return func(*args, **kwargs)
+    return wrapper
+
+
+# Graph store used by all tools; init_graph() points it at the graph of a codebase
+_store = GraphStore(GRAPH_FILE_PATH)
+
+if FLUSH_MODE == "batched":
+    atexit.register(_store.sync)
 
 
 @mcp.tool()
@@ -72,8 +456,6 @@ def init_graph(path: str) -> str:
     Returns:
         str: Status message indicating success and the path where graph was initialized
     """
-    global GRAPH_FILE_PATH
-
     # Convert to absolute path
     abs_root = os.path.abspath(path)
 
@@ -87,15 +469,19 @@ def init_graph(path: str) -> str:
     # Initialize empty graph
     graph = {
         "nodes": [],
-        "edges": []
+        "edges": [],
+        "highlightQuestions": {},
+        "_nextEdgeId": 0
     }
 
-    # Update the global graph file path
-    GRAPH_FILE_PATH = graph_file
+    with _store.lock:
+        # Point the store at the new graph file, dropping the graph cached for the old one
+        _store.reset(graph_file)
 
-    # Save the initial graph
-    with open(graph_file, "w") as f:
-        json.dump(graph, f, indent=2)
+        # Save the initial graph (this also caches it and drops any stale log)
+        _store.save(graph)
+        if WRITE_MODE == "log":
+            open(_store.log_path, "wb").close()
 
     # Copy the graph viewer HTML file
     viewer_source = Path(__file__).parent.parent / "D3JS-UI" / "graph-viewer.html"
@@ -106,13 +492,15 @@ def init_graph(path: str) -> str:
         viewer_msg = f"\nViewer copied to: {viewer_dest}"
     except FileNotFoundError:
         viewer_msg = f"\nWarning: Could not find viewer at {viewer_source}"
-    except Exception as e:
+    except OSError as e:
+        # Permission errors, copying onto itself (shutil.SameFileError), full disks, ...
         viewer_msg = f"\nWarning: Could not copy viewer: {str(e)}"
 
     return f"Successfully initialized graph at: {graph_file}\nCodebase root: {abs_root}{viewer_msg}"
 
 
 @mcp.tool()
+@transactional
 def add_nodes(node_list: list[dict[str, Any]]) -> str:
     """
     Add nodes to the code graph.
@@ -150,96 +538,64 @@ def add_nodes(node_list: list[dict[str, Any]]) -> str:
     Returns:
         str: Status message indicating success and number of nodes added/skipped
     """
-    graph = load_graph()
-    existing_ids = {node["id"] for node in graph["nodes"]}
+    graph = _store.load()
+    existing_ids = _store.node_index
 
-    added_count = 0
-    skipped_count = 0
-    
-    # Valid source code file extensions
-    VALID_EXTENSIONS = {'.py', '.js', '.ts', '.java', '.cpp', '.c', '.h', '.hpp', 
-                       '.cs', '.rb', '.go', '.rs', '.php', '.swift', '.kt'}
-
-    for node in node_list:
-        # Validate required fields
-        if "id" not in node or "type" not in node:
-            continue
+    nodes = graph["nodes"]
+    append_node = nodes.append
 
-        # Skip if node already exists
-        if node["id"] in existing_ids:
-            skipped_count += 1
-            continue
-        
-        # Validate node type
-        node_type = node.get("type", "").lower()
-        if node_type not in ["file", "class", "function"]:
+    added_count = 0
+    ops = []
+
+    # Validate the whole batch up front so only valid candidates reach the per-node setup.
+    # Nodes missing id or type are ignored; an unknown type, or a file node without a
+    # source code extension, counts as skipped.
+    with_fields = [node for node in node_list if "id" in node and "type" in node]
+    candidates = [
+        (node, node_type)
+        for node in with_fields
+        if (node_type := node["type"].lower()) in NODE_TYPES
+        and (node_type != "file" or node["id"].endswith(VALID_EXTENSIONS))
+    ]
+    skipped_count = len(with_fields) - len(candidates)
+
+    for node, node_type in candidates:
+        # Claim the id in one lookup; skip if the node already exists
+        node_idx = len(nodes)
+        if existing_ids.setdefault(node["id"], node_idx) != node_idx:
             skipped_count += 1
             continue
-        
-        # For file nodes, validate that they are source code files
-        if node_type == "file":
-            file_path = node.get("id", "")
-            # Check if file has a valid source code extension
-            has_valid_ext = any(file_path.endswith(ext) for ext in VALID_EXTENSIONS)
-            if not has_valid_ext:
-                skipped_count += 1
-                continue
+
+        # Share the interned type string
+        node["type"] = _CANONICAL_TYPES.get(node["type"], node["type"])
 
         # Ensure label exists (use id as fallback)
         if "label" not in node:
             node["label"] = node["id"].split(":")[-1] if ":" in node["id"] else node["id"]
 
         # Ensure highlight field exists as an array
-        if "highlight" not in node:
-            node["highlight"] = []
-        elif isinstance(node["highlight"], int):
-            # Convert old single-value format to array
-            if node["highlight"] > 0:
-                node["highlight"] = [node["highlight"]]
-            else:
-                node["highlight"] = []
-        elif not isinstance(node["highlight"], list):
-            node["highlight"] = []
-
-        # Ensure metadata exists
-        if "metadata" not in node:
-            node["metadata"] = {}
-        
-        # Validate metadata structure based on node type
-        metadata = node.get("metadata", {})
-        
-        if node_type == "file":
-            # File metadata should contain lists of classes and functions
-            if "classes" not in metadata:
-                metadata["classes"] = []
-            if "functions" not in metadata:
-                metadata["functions"] = []
-            # brief_summary is optional
-                
-        elif node_type == "class":
-            # Class metadata should contain method and attribute names
-            if "functions" not in metadata:
-                metadata["functions"] = []
-            if "attributes" not in metadata:
-                metadata["attributes"] = []
-            # children and brief_summary are optional
-                
-        elif node_type == "function":
-            # Function metadata should document parameters, return type, and documentation
-            if "parameters" not in metadata:
-                metadata["parameters"] = []
-            # returns, brief_summary, and full_documentation are optional
-
-        graph["nodes"].append(node)
-        existing_ids.add(node["id"])
+        _normalize_highlight(node)
+
+        # Ensure metadata exists with the fields required for the node type; fields the
+        # node already has win, and each node gets its own fresh default lists
+        node["metadata"] = {
+            **{field: [] for field in METADATA_DEFAULTS[node_type]},
+            **(node.get("metadata") or {}),
+        }
+
+        append_node(node)
+        ops.append({"op": "add_node", "data": node})
         added_count += 1
 
-    save_graph(graph)
+    # Nothing changed, so don't pay for rewriting the graph
+    if ops:
+        _store.save(graph, ops)
 
     return f"Added {added_count} node(s), skipped {skipped_count} existing/invalid node(s).\n\nIMPORTANT: Tell the user to open the graph viewer HTML file to see the visualization. Provide a clickable file path link to the graph-viewer.html file (it should be in the same directory as code_graph.json, typically in .brainsGraph/ folder). The graph will auto-refresh when changes are made."
 
 
 @mcp.tool()
+@transactional
 def add_edges(edge_list: list[dict[str, Any]]) -> str:
     """
     Add edges (relationships) to the code graph.
@@ -260,73 +616,146 @@ def add_edges(edge_list: list[dict[str, Any]]) -> str:
     Returns:
         str: Status message indicating success and number of edges added/skipped
     """
-    graph = load_graph()
-    node_ids = {node["id"] for node in graph["nodes"]}
+    graph = _store.load()
+    node_ids = _store.node_index
 
-    # Create set of existing edges for deduplication
-    existing_edges = {
-        (edge["source"], edge["target"], edge["type"])
-        for edge in graph["edges"]
-    }
+    # Existing edges by signature, for deduplication
+    existing_edges = _store.edge_sig_index
 
     added_count = 0
     skipped_count = 0
-    
-    # Valid edge types
-    VALID_EDGE_TYPES = {"inherit", "invokes", "contains"}
+    ops = []
+    # Work on a local copy of the edge counter and store it once after the loop
+    next_id = graph["_nextEdgeId"]
 
     for edge in edge_list:
         # Validate required fields
         if "source" not in edge or "target" not in edge or "type" not in edge:
             continue
         
-        # Validate edge type
-        edge_type = edge.get("type", "").lower()
-        if edge_type not in VALID_EDGE_TYPES:
+        # Validate edge type, only lowercasing it when it isn't already canonical
+        edge_type = EDGE_TYPE_CANON.get(edge["type"]) or EDGE_TYPE_CANON.get(edge["type"].lower())
+        if edge_type is None:
             skipped_count += 1
             continue
 
         # Create edge signature
         edge_sig = (edge["source"], edge["target"], edge_type)
 
-        # Skip if edge already exists
-        if edge_sig in existing_edges:
+        # Validate that source and target nodes exist
+        if edge["source"] not in node_ids or edge["target"] not in node_ids:
             skipped_count += 1
             continue
 
-        # Validate that source and target nodes exist
-        if edge["source"] not in node_ids or edge["target"] not in node_ids:
+        # Claim the signature in one lookup; skip if the edge already exists
+        edge_idx = len(graph["edges"])
+        if existing_edges.setdefault(edge_sig, edge_idx) != edge_idx:
             skipped_count += 1
             continue
 
-        # Generate edge ID
-        edge["id"] = get_next_edge_id(graph)
+        # Generate edge ID from the persisted counter
+        edge["id"] = f"edge_{next_id}"
+        next_id += 1
         
         # Normalize edge type
         edge["type"] = edge_type
 
         # Ensure highlight field exists as an array
-        if "highlight" not in edge:
-            edge["highlight"] = []
-        elif isinstance(edge["highlight"], int):
-            # Convert old single-value format to array
-            if edge["highlight"] > 0:
-                edge["highlight"] = [edge["highlight"]]
-            else:
-                edge["highlight"] = []
-        elif not isinstance(edge["highlight"], list):
-            edge["highlight"] = []
+        _normalize_highlight(edge)
 
+        _store.index_edge(edge, edge_idx)
         graph["edges"].append(edge)
-        existing_edges.add(edge_sig)
+        ops.append({"op": "add_edge", "data": edge})
         added_count += 1
 
-    save_graph(graph)
+    graph["_nextEdgeId"] = next_id
+
+    # Nothing changed, so don't pay for rewriting the graph
+    if ops:
+        _store.save(graph, ops)
 
     return f"Added {added_count} edge(s), skipped {skipped_count} existing/invalid edge(s).\n\nIMPORTANT: Tell the user to open the graph viewer HTML file to see the visualization. Provide a clickable file path link to the graph-viewer.html file (it should be in the same directory as code_graph.json, typically in .brainsGraph/ folder). The graph will auto-refresh when changes are made."
 
 
+def _highlight_nodes(node_ids: list[str], color: int, question: str = "") -> int:
+    """Add color to the given nodes and record question; return how many nodes have the color."""
+    graph = _store.load()
+
+    # Initialize highlightQuestions if not present
+    if "highlightQuestions" not in graph:
+        graph["highlightQuestions"] = {}
+
+    # Update the specified nodes by adding the color to their highlight array
+    highlighted_count = 0
+    ops = []
+    nodes = graph["nodes"]
+
+    # Only visit the requested nodes instead of sweeping the whole node list
+    for node_id in set(node_ids):
+        idx = _store.node_index.get(node_id)
+        if idx is None:
+            continue
+        node = nodes[idx]
+
+        # Ensure highlight is an array
+        highlight = _normalize_highlight(node)
+
+        # Add the color if not already present
+        if color not in highlight and color > 0:
+            highlight.append(color)
+            ops.append({"op": "highlight_node", "id": node_id, "color": color})
+            highlighted_count += 1
+        elif color in highlight:
+            highlighted_count += 1
+
+    # Store the question for this color (always update if provided)
+    if question and graph["highlightQuestions"].get(str(color)) != question:
+        graph["highlightQuestions"][str(color)] = question
+        ops.append({"op": "set_question", "color": str(color), "question": question})
+
+    # Nothing changed, so don't pay for rewriting the graph
+    if ops:
+        _store.save(graph, ops)
+
+    return highlighted_count
+
+
+def _highlight_edges(edge_ids: list[str], color: int) -> int:
+    """Add color to the given edges; return how many edges have the color."""
+    graph = _store.load()
+
+    # Update the specified edges by adding the color to their highlight array
+    highlighted_count = 0
+    ops = []
+    edges = graph["edges"]
+
+    # Only visit the requested edges instead of sweeping the whole edge list
+    for edge_id in set(edge_ids):
+        idx = _store.edge_id_index.get(edge_id)
+        if idx is None:
+            continue
+        edge = edges[idx]
+
+        # Ensure highlight is an array
+        highlight = _normalize_highlight(edge)
+
+        # Add the color if not already present
+        if color not in highlight and color > 0:
+            highlight.append(color)
+            ops.append({"op": "highlight_edge", "id": edge_id, "color": color})
+            highlighted_count += 1
+        elif color in highlight:
+            highlighted_count += 1
+
+    # Nothing changed, so don't pay for rewriting the graph
+    if ops:
+        _store.save(graph, ops)
+
+    return highlighted_count
+
+
 @mcp.tool()
+@transactional
 def highlight_nodes(node_ids: list[str], color: int, question: str = "") -> str:
     """
     Highlight specific nodes in the graph to answer a question.
@@ -358,42 +787,13 @@ def highlight_nodes(node_ids: list[str], color: int, question: str = "") -> str:
     Returns:
         str: Status message indicating success and number of nodes highlighted
     """
-    graph = load_graph()
-
-    # Initialize highlightQuestions if not present
-    if "highlightQuestions" not in graph:
-        graph["highlightQuestions"] = {}
-
-    # Update the specified nodes by adding the color to their highlight array
-    highlighted_count = 0
-    node_id_set = set(node_ids)
-
-    for node in graph["nodes"]:
-        if node["id"] in node_id_set:
-            # Ensure highlight is an array
-            if not isinstance(node.get("highlight"), list):
-                if isinstance(node.get("highlight"), int) and node["highlight"] > 0:
-                    node["highlight"] = [node["highlight"]]
-                else:
-                    node["highlight"] = []
-
-            # Add the color if not already present
-            if color not in node["highlight"] and color > 0:
-                node["highlight"].append(color)
-                highlighted_count += 1
-            elif color in node["highlight"]:
-                highlighted_count += 1
-
-    # Store the question for this color (always update if provided)
-    if question:
-        graph["highlightQuestions"][str(color)] = question
-
-    save_graph(graph)
+    highlighted_count = _highlight_nodes(node_ids, color, question)
 
     return f"Highlighted {highlighted_count} node(s) with color {color}.\n\nIMPORTANT: Tell the user to open the graph viewer HTML file to see the highlighted nodes. Provide a clickable file path link to the graph-viewer.html file (it should be in the same directory as code_graph.json, typically in .brainsGraph/ folder). The graph will auto-refresh when changes are made."
 
 
 @mcp.tool()
+@transactional
 def highlight_edges(edge_ids: list[str], color: int) -> str:
     """
     Highlight specific edges in the graph.
@@ -407,6 +807,7 @@ def highlight_edges(edge_ids: list[str], color: int) -> str:
     To find which edges to highlight:
     1. Look at the node IDs you just highlighted
     2. Find all edges where source OR target matches any of those node IDs
+       (edges_for_nodes() returns exactly these edges)
     3. Pass those edge IDs to this function with the same color
 
     Note: This function ADDS the color to each edge's highlight array. If the edge already has other colors
@@ -420,31 +821,35 @@ def highlight_edges(edge_ids: list[str], color: int) -> str:
     Returns:
         str: Status message indicating success and number of edges highlighted
     """
-    graph = load_graph()
+    highlighted_count = _highlight_edges(edge_ids, color)
 
-    # Update the specified edges by adding the color to their highlight array
-    highlighted_count = 0
-    edge_id_set = set(edge_ids)
+    return f"Highlighted {highlighted_count} edge(s) with color {color}.\n\nIMPORTANT: Tell the user to open the graph viewer HTML file to see the highlighted edges. Provide a clickable file path link to the graph-viewer.html file (it should be in the same directory as code_graph.json, typically in .brainsGraph/ folder). The graph will auto-refresh when changes are made."
 
-    for edge in graph["edges"]:
-        if edge["id"] in edge_id_set:
-            # Ensure highlight is an array
-            if not isinstance(edge.get("highlight"), list):
-                if isinstance(edge.get("highlight"), int) and edge["highlight"] > 0:
-                    edge["highlight"] = [edge["highlight"]]
-                else:
-                    edge["highlight"] = []
 
-            # Add the color if not already present
-            if color not in edge["highlight"] and color > 0:
-                edge["highlight"].append(color)
-                highlighted_count += 1
-            elif color in edge["highlight"]:
-                highlighted_count += 1
+@mcp.tool()
+@transactional
+def highlight(node_ids: list[str], edge_ids: list[str], color: int, question: str = "") -> str:
+    """
+    Highlight nodes and the edges connecting them with one color, in a single step.
+
+    Equivalent to calling highlight_nodes(node_ids, color, question) followed by
+    highlight_edges(edge_ids, color), but the graph file is only written once.
+    The same rules apply: call read_graph() first, use one color (1-10) per question,
+    and include the edges connected to the highlighted nodes (see edges_for_nodes()).
 
-    save_graph(graph)
+    Args:
+        node_ids: List of node IDs to highlight (must exist in the graph)
+        edge_ids: List of edge IDs to highlight (must exist in the graph)
+        color: Color code as integer (1-10, where 0 = no highlight)
+        question: The specific question this highlight answers (REQUIRED - one question per color)
 
-    return f"Highlighted {highlighted_count} edge(s) with color {color}.\n\nIMPORTANT: Tell the user to open the graph viewer HTML file to see the highlighted edges. Provide a clickable file path link to the graph-viewer.html file (it should be in the same directory as code_graph.json, typically in .brainsGraph/ folder). The graph will auto-refresh when changes are made."
+    Returns:
+        str: Status message indicating success and number of nodes and edges highlighted
+    """
+    node_count = _highlight_nodes(node_ids, color, question)
+    edge_count = _highlight_edges(edge_ids, color)
+
+    return f"Highlighted {node_count} node(s) and {edge_count} edge(s) with color {color}.\n\nIMPORTANT: Tell the user to open the graph viewer HTML file to see the highlighted nodes and edges. Provide a clickable file path link to the graph-viewer.html file (it should be in the same directory as code_graph.json, typically in .brainsGraph/ folder). The graph will auto-refresh when changes are made."
 
 
 @mcp.tool()
@@ -465,8 +870,59 @@ def read_graph() -> str:
     Returns:
         str: JSON string representation of the entire graph including nodes, edges, and highlightQuestions
     """
-    graph = load_graph()
-    return json.dumps(graph, indent=2)
+    with _store.lock:
+        # Reading is a natural checkpoint: fold any logged changes into the file the viewer polls
+        if WRITE_MODE == "log":
+            _store.compact()
+        graph = _store.load()
+        # The file on disk is compact; only the human-facing copy is pretty-printed
+        return _dumps(graph, indent=True).decode("utf-8")
+
+
+@mcp.tool()
+def edges_for_nodes(node_ids: list[str]) -> str:
+    """
+    Return all edges connected to the given nodes.
+
+    Use this after highlight_nodes() to find the edge IDs to pass to highlight_edges():
+    an edge is returned when its source OR target is one of the given node IDs.
+
+    Args:
+        node_ids: List of node IDs whose incoming and outgoing edges should be returned
+
+    Returns:
+        str: JSON array of the matching edges (each edge appears once)
+    """
+    with _store.lock:
+        graph = _store.load()
+        edges = graph["edges"]
+
+        edge_ids: dict[str, None] = {}
+        for node_id in node_ids:
+            for edge_id in _store.out_adj.get(node_id, ()):
+                edge_ids[edge_id] = None
+            for edge_id in _store.in_adj.get(node_id, ()):
+                edge_ids[edge_id] = None
+
+        return _dumps([edges[_store.edge_id_index[edge_id]] for edge_id in edge_ids], indent=True).decode("utf-8")
+
+
+@mcp.tool()
+def compact_graph() -> str:
+    """
+    Fold the append-only change log back into the graph JSON file.
+
+    Only needed when the server runs with WRITE_MODE=log: changes are then appended to
+    code_graph.log and the graph viewer picks them up once they are compacted into
+    code_graph.json. The log is also compacted automatically once it outgrows a tenth
+    of the graph file, and whenever read_graph() is called. Safe to call in any mode.
+
+    Returns:
+        str: Status message with the path of the compacted graph file
+    """
+    with _store.lock:
+        _store.compact()
+        return f"Compacted graph into: {_store.path}"
 
 
 if __name__ == "__main__":